@@ -0,0 +1,88 @@
+"""
+Compare fetching documents with plain Cushion callbacks against the
+tornado.gen tasks wrapper.
+
+    python benchmarks/bench_cushion_tasks.py [couch_uri] [docs] [batch]
+
+Needs a running CouchDB.  A throwaway database is created and deleted.  Each
+run fetches the same docs:
+
+callback -> one after another, each fetch started from the last callback
+tasks -> batch fetches at a time with `yield [tasks.one(..), ...]`
+many -> batch ids at a time through a single _all_docs request
+"""
+
+import os
+import sys
+import time
+from random import randint
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import tornado.gen
+import tornado.ioloop
+
+from tornado_addons.cushion import Cushion
+
+
+def main():
+    uri = sys.argv[1] if len(sys.argv) > 1 else 'http://localhost:5984'
+    ndocs = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    batch = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+    io_loop = tornado.ioloop.IOLoop.instance()
+    cushion = Cushion(uri, io_loop=io_loop, max_clients=batch)
+    tasks = cushion.tasks
+    dbname = 'bench_db' + str(randint(100, 100000))
+    ids = []
+    results = {}
+
+    def run_callbacks(callback):
+        remaining = list(ids)
+        def next_(doc=None):
+            if not remaining:
+                callback()
+                return
+            cushion.one(dbname, remaining.pop(), next_)
+        next_()
+
+    @tornado.gen.engine
+    def run_tasks(callback):
+        for i in xrange(0, len(ids), batch):
+            yield [tasks.one(dbname, _id) for _id in ids[i:i + batch]]
+        callback()
+
+    @tornado.gen.engine
+    def run_many(callback):
+        for i in xrange(0, len(ids), batch):
+            yield tasks.many(dbname, ids[i:i + batch])
+        callback()
+
+    @tornado.gen.engine
+    def bench():
+        yield tasks.open(dbname, create=True)
+        for i in xrange(ndocs):
+            doc = yield tasks.save(dbname, {'n': i, 'pad': 'x' * 256})
+            ids.append(doc.id)
+
+        for name, func in (('callback', run_callbacks),
+                           ('tasks', run_tasks),
+                           ('many', run_many)):
+            start = time.time()
+            yield tornado.gen.Task(func)
+            results[name] = time.time() - start
+
+        yield tornado.gen.Task(cushion._server.delete, dbname)
+        io_loop.stop()
+
+    bench()
+    io_loop.start()
+
+    print 'docs=%d batch=%d' % (ndocs, batch)
+    for name in ('callback', 'tasks', 'many'):
+        print '%-8s %7.3fs  %8.1f docs/s' % (
+            name, results[name], ndocs / results[name])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Memory benchmark for Cushion projections and record types.
+
+Builds a large fake view response (the same rows trombi hands to
+Cushion.view), then keeps the results around as full dicts, projected dicts,
+slotted records and tuple records.  Each mode runs in its own process so the
+RSS numbers don't bleed into each other.
+
+    python benchmarks/bench_records.py [rows] [doc_kb]
+
+Linux only, RSS is read from /proc/self/statm.
+"""
+
+import gc
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tornado_addons.cushion import project
+
+FIELDS = ['_id', 'name', 'email', 'plan', 'created']
+MODES = ['full', 'dict', 'slots', 'tuple']
+
+
+def rss_kb():
+    pages = int(open('/proc/self/statm').read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def fake_rows(rows, doc_kb):
+    filler = 'x' * 64
+    for i in xrange(rows):
+        doc = {
+            '_id': 'doc%08d' % i,
+            '_rev': '1-abc',
+            'name': 'user %d' % i,
+            'email': 'user%d@example.com' % i,
+            'plan': 'free',
+            'created': 1300000000 + i,
+            }
+        for j in xrange(doc_kb * 1024 // 80):
+            doc['blob%d' % j] = filler
+        yield json.dumps({'id': doc['_id'], 'key': i, 'value': doc})
+
+
+def run(mode, rows, doc_kb):
+    base = rss_kb()
+    kept = []
+    for line in fake_rows(rows, doc_kb):
+        row = json.loads(line)
+        if mode == 'full':
+            kept.append(row['value'])
+        elif mode == 'dict':
+            kept.append(project(row['value'], FIELDS))
+        else:
+            kept.append(project(row['value'], FIELDS, mode))
+        del row
+    gc.collect()
+    return rss_kb() - base
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    doc_kb = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    print 'rows=%d doc_kb=%d fields=%s' % (rows, doc_kb, ','.join(FIELDS))
+    for mode in MODES:
+        r, w = os.pipe()
+        pid = os.fork()
+        if not pid:
+            os.close(r)
+            os.write(w, str(run(mode, rows, doc_kb)))
+            os._exit(0)
+        os.close(w)
+        delta = int(os.read(r, 64))
+        os.waitpid(pid, 0)
+        print '%-6s rss +%8d KB' % (mode, delta)
+
+
+if __name__ == '__main__':
+    main()
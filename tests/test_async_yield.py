@@ -1,6 +1,9 @@
 
 from ..tornado_addons.async_yield import async_yield, AsyncYieldMixin
+from ..tornado_addons.async_yield import AdmissionController
+from ..tornado_addons import async_yield as async_yield_mod
 
+import time
 import tornado
 from random import randint
 
@@ -72,3 +75,129 @@ class AYHandlerTests(AsyncTestCase):
         retval = self.wait()
         self.assertTrue(len(retval) == 3 and retval[1] == 2)
 
+
+
+class LimitedHandler(AYHandler):
+
+    def send_error(self, status_code=500, **kwargs):
+        self.error_sent = status_code
+
+    @async_yield
+    def limited(self, ioloop, val, callback):
+        self.test_ioloop = ioloop
+        results = yield self.async_assign(val, self.yield_cb)
+        # pull in another generator to make sure it isn't counted twice
+        yield self.embedded_async(self.yield_cb)
+        callback(results)
+
+    @async_yield
+    def stuck(self, callback):
+        # nothing ever calls yield_cb, so this never resumes
+        yield None
+        callback('never')
+
+
+class AdmissionTests(AsyncTestCase):
+
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        async_yield_mod._controllers.clear()
+        LimitedHandler.admission = dict(
+            limit=1, queue_size=1, queue_timeout=5, io_loop=self.io_loop )
+
+    def tearDown(self):
+        async_yield_mod._controllers.clear()
+        LimitedHandler.admission = None
+
+    def _handler(self):
+        h = LimitedHandler()
+        h.prepare()
+        h.error_sent = None
+        return h
+
+    def test_unlimited_by_default(self):
+        self.assertTrue(AYHandler.admission is None)
+        self.assertTrue(AYHandler.admission_stats() is None)
+
+    def test_queue_then_reject(self):
+        results = []
+        first, second, third = self._handler(), self._handler(), self._handler()
+        for h, val in ((first, 1), (second, 2), (third, 3)):
+            h.limited(self.io_loop, val, results.append)
+
+        # one running, one queued, no room left for the third
+        stats = LimitedHandler.admission_stats()
+        self.assertEqual(stats['in_flight'], 1)
+        self.assertEqual(stats['queued'], 1)
+        self.assertEqual(stats['rejected'], 1)
+        self.assertEqual(third.error_sent, 503)
+
+        def check():
+            if len(results) == 2: self.stop()
+            else: self.io_loop.add_callback(check)
+        check()
+        self.wait()
+
+        self.assertEqual(results, [1, 2])
+        stats = LimitedHandler.admission_stats()
+        self.assertEqual(stats['in_flight'], 0)
+        self.assertEqual(stats['admitted'], 2)
+
+    def _run_until(self, test):
+        def check():
+            if test(): self.stop()
+            else: self.io_loop.add_timeout(time.time() + 0.01, check)
+        check()
+        self.wait()
+
+    def test_stuck_generator_released_on_finish(self):
+        results = []
+        first, second = self._handler(), self._handler()
+        first.stuck(results.append)
+        second.limited(self.io_loop, 2, results.append)
+        self.assertEqual(LimitedHandler.admission_stats()['queued'], 1)
+
+        first.on_finish()
+        # the queued request starts on its own turn of the loop, not inside
+        # the first request's finish
+        self.assertEqual(results, [])
+        self._run_until(lambda: results)
+        self.assertEqual(results, [2])
+        self.assertEqual(LimitedHandler.admission_stats()['in_flight'], 0)
+
+        # finishing again doesn't hand back a second slot
+        first.on_finish()
+        self.assertEqual(LimitedHandler.admission_stats()['in_flight'], 0)
+
+    def test_stuck_generator_slot_expires(self):
+        LimitedHandler.admission['slot_timeout'] = 0.05
+        results = []
+        first, second = self._handler(), self._handler()
+        first.stuck(results.append)
+        second.limited(self.io_loop, 2, results.append)
+
+        self._run_until(lambda: results)
+        self.assertEqual(results, [2])
+        stats = LimitedHandler.admission_stats()
+        self.assertEqual(stats['expired'], 1)
+        self.assertEqual(stats['in_flight'], 0)
+
+    def test_queue_timeout(self):
+        LimitedHandler.admission['queue_timeout'] = 0.01
+        LimitedHandler.admission['queue_size'] = 5
+        ctl = AdmissionController(**LimitedHandler.admission)
+        # take the only slot and never give it back
+        ctl.admit(lambda done: None, lambda: None)
+        ctl.admit(lambda done: None, self.stop)
+        self.wait()
+        self.assertEqual(ctl.stats()['timed_out'], 1)
+        self.assertEqual(ctl.stats()['queued'], 0)
+
+    def test_aimd(self):
+        ctl = AdmissionController(
+            limit=10, target_latency=0.5, backoff=0.5, io_loop=self.io_loop )
+        ctl.in_flight = 2
+        ctl._done(1.0)
+        self.assertEqual(ctl.stats()['limit'], 5)
+        ctl._done(0.1)
+        self.assertTrue(5 < ctl.limit < 6)
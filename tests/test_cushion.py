@@ -9,10 +9,16 @@ try:
 except:
     no_trombi = True
 
-from unittest import skipIf
+from unittest import skipIf, TestCase
+import json
+import time
 from random import randint
 from tornado.testing import AsyncTestCase
 from ..tornado_addons.cushion import Cushion, CushionException, CushionDBNotReady
+from ..tornado_addons.cushion import record_type, project, CushionTasks
+from ..tornado_addons.cushion import design_changed
+
+import tornado.gen
 
 baseurl = 'http://localhost:5984'
 
@@ -140,6 +146,49 @@ class CushionTests(AsyncTestCase):
         # should be a dict
         self.assertTrue( type({}) == type(retval) )
 
+    def test_one_fields(self):
+        doc = self._save_some_data({'shoes':11, 'hat':'fitted'}).raw()
+        self.cushion.one(self.dbname, doc['_id'], self.stop, fields=['shoes'])
+        retval = self.wait()
+        self.assertEqual(retval, {'shoes': 11})
+
+    def test_one_record(self):
+        doc = self._save_some_data({'shoes':11, 'hat':'fitted'}).raw()
+        self.cushion.one(
+            self.dbname, doc['_id'], self.stop,
+            fields=['_id', 'hat'], record='slots' )
+        retval = self.wait()
+        self.assertEqual(retval.hat, 'fitted')
+        self.assertEqual(retval['_id'], doc['_id'])
+        self.assertFalse(hasattr(retval, 'shoes'))
+
+    def test_many(self):
+        a = self._save_some_data({'shoes':11}).raw()
+        b = self._save_some_data({'shoes':12}).raw()
+        self.cushion.many(
+            self.dbname, [b['_id'], 'just_not_there', a['_id']], self.stop )
+        docs = self.wait()
+        self.assertEqual(docs[0]['shoes'], 12)
+        self.assertTrue(docs[1] is None)
+        self.assertEqual(docs[2]['shoes'], 11)
+
+    def test_tasks(self):
+        a = self._save_some_data({'shoes':11}).raw()
+        b = self._save_some_data({'shoes':12}).raw()
+        tasks = self.cushion.tasks
+
+        @tornado.gen.engine
+        def fetch_both():
+            docs = yield [
+                tasks.one(self.dbname, a['_id']),
+                tasks.one(self.dbname, b['_id'], fields=['shoes']) ]
+            self.stop(docs)
+
+        fetch_both()
+        docs = self.wait()
+        self.assertEqual(docs[0]['shoes'], 11)
+        self.assertEqual(docs[1], {'shoes': 12})
+
     def test_view(self):
         # This test does quite a bit.  First, create 4 test records.
         # Then, create a view that will emit those records and insert that into
@@ -170,5 +219,349 @@ class CushionTests(AsyncTestCase):
 
         self.assertTrue(len(records) == 2)
 
+        self.cushion.view(
+            self.dbname, 'test/view', self.stop, key='b',
+            fields=['foo'], record='tuple' )
+        records = self.wait()
+        self.assertEqual(sorted(r.foo for r in records), [3, 4])
+
         # OPTIMIZE: do more to ensure we're getting back what we want
 
+    def test_sync_designs(self):
+        self._save_some_data({'foo': 1, 'bar': 'a'})
+        design = lambda val: {'test': {
+            'language': 'javascript',
+            'views': {'by_bar': {
+                'map': "function (doc) { emit(doc.bar, %d); }" % val }},
+            }}
+        results = []
+        def wait_for(test):
+            def check():
+                if test(): self.stop()
+                else: self.io_loop.add_timeout(time.time() + 0.05, check)
+            check()
+            self.wait()
+
+        seen = []
+        self.cushion.sync_designs(
+            [self.dbname], design(1), results.append, poll_interval=0.05,
+            progress=lambda *a: seen.append(a) )
+        wait_for(lambda: results)
+        self.assertEqual(results[0]['updated'], [self.dbname])
+        self.assertEqual(seen, [(1, 1, self.dbname)])
+        self.assertEqual(self.cushion.warming(), set())
+
+        self.cushion.view(self.dbname, 'test/by_bar', self.stop)
+        rows = list(self.wait())
+        self.assertEqual([(r['key'], r['value']) for r in rows], [('a', 1)])
+
+        # change the view, live queries keep getting full, correct rows from
+        # the old index while the new one builds
+        self.cushion.sync_designs(
+            [self.dbname], design(2), results.append, poll_interval=0.05 )
+        self.cushion.view(self.dbname, 'test/by_bar', self.stop)
+        rows = list(self.wait())
+        self.assertEqual(len(rows), 1)
+        self.assertTrue((rows[0]['key'], rows[0]['value']) in
+                        (('a', 1), ('a', 2)))
+
+        wait_for(lambda: len(results) == 2)
+        self.assertEqual(results[1]['updated'], [self.dbname])
+        self.cushion.view(self.dbname, 'test/by_bar', self.stop)
+        rows = list(self.wait())
+        self.assertEqual([(r['key'], r['value']) for r in rows], [('a', 2)])
+        self.cushion.one(self.dbname, '_design/test__new', self.stop)
+        self.assertTrue(self.wait() is None)
+
+        # pushing the same thing again shouldn't touch the db
+        self.cushion.sync_designs([self.dbname], design(2), self.stop)
+        self.assertEqual(self.wait()['unchanged'], [self.dbname])
+
+
+class FakeResponse(object):
+
+    def __init__(self, code, body):
+        self.code = code
+        self.body = json.dumps(body)
+
+
+class FakeDesignDB(object):
+    """
+    just enough of a trombi Database for sync_designs.  An index build takes
+    two _info polls to finish.
+    """
+
+    building = set() # (dbname, design id) across every fake db
+    most_building = [0]
+
+    def __init__(self, name, docs=None):
+        self.name = name
+        self.error = False
+        self.docs = dict(docs or {})
+        self.polls = {}
+        self.broken = False # index builds never finish
+
+    def view(self, design_doc, viewname, callback, keys=None, **ka):
+        rows = []
+        for k in keys:
+            if k in self.docs: rows.append({'key': k, 'doc': self.docs[k]})
+            else: rows.append({'key': k, 'error': 'not_found'})
+        callback(trombi.client.ViewResult({'rows': rows}))
+
+    def bulk_docs(self, docs, callback):
+        for doc in docs:
+            have = self.docs.get(doc['_id'])
+            assert (have and have['_rev']) == doc.get('_rev'), doc
+            if doc.get('_deleted'):
+                del self.docs[doc['_id']]
+            else:
+                self.docs[doc['_id']] = dict(doc, _rev=str(randint(1, 10**6)))
+        callback(trombi.client.BulkResult(
+            [{'id': d['_id'], 'rev': '1'} for d in docs] ))
+
+    def _fetch(self, url, callback):
+        ddoc = '/'.join(url.split('/')[:2])
+        if self.broken and '/_view/' in url:
+            callback(FakeResponse(500, {'reason': 'compilation_error'}))
+        elif self.broken:
+            callback(FakeResponse(200, {'view_index': {
+                'update_seq': 0, 'updater_running': False }}))
+        elif '/_view/' in url:
+            self.building.add((self.name, ddoc))
+            self.most_building[0] = max(
+                self.most_building[0], len(self.building))
+            callback(FakeResponse(200, {'rows': []}))
+        elif url.endswith('/_info'):
+            self.polls[ddoc] = self.polls.get(ddoc, 0) + 1
+            done = self.polls[ddoc] >= 2
+            if done: self.building.discard((self.name, ddoc))
+            callback(FakeResponse(200, {'view_index': {
+                'update_seq': 1 if done else 0,
+                'updater_running': not done }}))
+
+
+@skipIf(no_trombi, "not testing Cushion, trombi failed to import")
+class SyncDesignsTests(AsyncTestCase):
+
+    designs = {'users': {
+        'language': 'javascript',
+        'views': {'by_email': {'map': 'new'}},
+        'validate_doc_update': 'function () {}',
+        }}
+
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        FakeDesignDB.building.clear()
+        FakeDesignDB.most_building[0] = 0
+        self.cushion = Cushion(baseurl, io_loop=self.io_loop)
+        old = {'_design/users': {
+            '_id': '_design/users', '_rev': '1-a', 'language': 'javascript',
+            'views': {'by_email': {'map': 'old'}} }}
+        self.dbs = dict(
+            (n, FakeDesignDB(n, old)) for n in ('db%d' % i for i in range(6)))
+        self.cushion._server.get = lambda name, callback, create: \
+            callback(self.dbs[name])
+
+    def test_staged_then_swapped(self):
+        db = self.dbs['db0']
+        results = []
+        self.cushion.sync_designs(
+            ['db0'], self.designs, results.append, poll_interval=0.01 )
+
+        # built under the staging id, live design untouched for now
+        staged = db.docs['_design/users__new']
+        self.assertEqual(staged['views'], self.designs['users']['views'])
+        self.assertFalse('validate_doc_update' in staged)
+        self.assertEqual(
+            db.docs['_design/users']['views']['by_email']['map'], 'old')
+        self.assertEqual(self.cushion.warming(), set([('db0', 'users')]))
+
+        def check():
+            if results: self.stop()
+            else: self.io_loop.add_callback(check)
+        check()
+        self.wait()
+
+        self.assertEqual(results[0]['updated'], ['db0'])
+        self.assertEqual(
+            db.docs['_design/users']['validate_doc_update'], 'function () {}')
+        self.assertEqual(
+            db.docs['_design/users']['views']['by_email']['map'], 'new')
+        self.assertFalse('_design/users__new' in db.docs)
+        self.assertEqual(self.cushion.warming(), set())
+
+    def test_builds_bounded(self):
+        progress = []
+        self.cushion.sync_designs(
+            sorted(self.dbs), self.designs, self.stop, concurrency=2,
+            poll_interval=0.01, progress=lambda *a: progress.append(a) )
+        summary = self.wait()
+        self.assertEqual(sorted(summary['updated']), sorted(self.dbs))
+        self.assertEqual(FakeDesignDB.most_building[0], 2)
+        self.assertEqual([p[0] for p in progress], range(1, 7))
+
+    def _never_builds(self, **ka):
+        for db in self.dbs.values(): db.broken = True
+        self.cushion.sync_designs(
+            sorted(self.dbs), self.designs, self.stop, poll_interval=0.01,
+            **ka )
+        summary = self.wait()
+        self.assertEqual(sorted(summary['errors']), sorted(self.dbs))
+        self.assertEqual(summary['updated'], [])
+        self.assertEqual(self.cushion.warming(), set())
+        # the live design was never touched
+        for db in self.dbs.values():
+            self.assertEqual(
+                db.docs['_design/users']['views']['by_email']['map'], 'old')
+        return summary
+
+    def test_build_kickoff_fails(self):
+        summary = self._never_builds(concurrency=2)
+        self.assertTrue('compilation_error' in summary['errors']['db0'])
+
+    def test_build_times_out(self):
+        # the kick off works, but the index never gets built
+        original = FakeDesignDB._fetch
+        def fetch(db, url, callback):
+            if '/_view/' in url: callback(FakeResponse(200, {'rows': []}))
+            else: original(db, url, callback)
+        FakeDesignDB._fetch = fetch
+        self.addCleanup(setattr, FakeDesignDB, '_fetch', original)
+        summary = self._never_builds(concurrency=2, build_timeout=0.05)
+        self.assertTrue("didn't finish" in summary['errors']['db0'])
+
+    def test_unchanged(self):
+        self.cushion.sync_designs(['db0'], self.designs, self.stop,
+                                  poll_interval=0.01)
+        self.wait()
+        self.cushion.sync_designs(['db0'], self.designs, self.stop)
+        self.assertEqual(self.wait()['unchanged'], ['db0'])
+
+    def test_no_warm(self):
+        self.cushion.sync_designs(['db0'], self.designs, self.stop, warm=False)
+        self.assertEqual(self.wait()['updated'], ['db0'])
+        docs = self.dbs['db0'].docs
+        self.assertEqual(docs['_design/users']['views']['by_email']['map'], 'new')
+        self.assertFalse('_design/users__new' in docs)
+
+
+class FakeCushion(object):
+
+    def __init__(self, io_loop):
+        self.io_loop = io_loop
+
+    def one(self, db, _id, callback, **ka):
+        self.io_loop.add_callback(lambda: callback((db, _id)))
+
+
+@skipIf(no_trombi, "not testing Cushion, trombi failed to import")
+class CushionTasksTests(AsyncTestCase):
+
+    def test_tasks_gather(self):
+        tasks = CushionTasks(FakeCushion(self.io_loop))
+
+        @tornado.gen.engine
+        def fetch():
+            docs = yield [tasks.one('a', '1'), tasks.one('b', '2')]
+            self.stop(docs)
+
+        fetch()
+        self.assertEqual(self.wait(), [('a', '1'), ('b', '2')])
+
+    def test_tasks_only_cushion_calls(self):
+        tasks = CushionTasks(FakeCushion(self.io_loop))
+        self.assertRaises(AttributeError, getattr, tasks, 'io_loop')
+
+
+@skipIf(no_trombi, "not testing Cushion, trombi failed to import")
+class DesignChangedTests(TestCase):
+
+    def test_design_changed(self):
+        views = {'views': {'v': {'map': 'function (doc) {}'}}}
+        have = dict(views, _id='_design/x', _rev='1-abc')
+        self.assertFalse(design_changed(have, dict(views, _id='_design/x')))
+        self.assertTrue(design_changed(None, views))
+        self.assertTrue(
+            design_changed(have, {'views': {'v': {'map': 'function () {}'}}}) )
+
+
+class FakeViewDB(object):
+    """
+    stands in for a trombi Database, every view returns rows
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def view(self, design_doc, viewname, callback, **ka):
+        callback(trombi.client.ViewResult({'rows': self.rows}))
+
+
+@skipIf(no_trombi, "not testing Cushion, trombi failed to import")
+class ViewProjectionTests(TestCase):
+
+    def setUp(self):
+        self.cushion = Cushion(baseurl)
+
+    def tearDown(self):
+        self.cushion._pool.pop('fake_view_db', None)
+
+    def _view(self, rows, **ka):
+        self.cushion._pool['fake_view_db'] = FakeViewDB(rows)
+        results = []
+        self.cushion.view('fake_view_db', 'test/view', results.append, **ka)
+        return results[0]
+
+    def test_view_fields_from_value(self):
+        records = self._view(
+            [{'id': 'a', 'key': 'a', 'value': {'foo': 1, 'bar': 'x'}}],
+            fields=['foo'] )
+        self.assertEqual(records, [{'foo': 1}])
+
+    def test_view_fields_from_doc(self):
+        records = self._view(
+            [{'id': 'a', 'key': 'a', 'value': 1, 'doc': {'foo': 2}}],
+            fields=['foo'], include_docs=True )
+        self.assertEqual(records, [{'foo': 2}])
+
+    def test_view_fields_scalar_value(self):
+        # emit(key, 1) has nothing to pick fields out of
+        self.assertRaises(
+            CushionException, self._view,
+            [{'id': 'a', 'key': 'a', 'value': 1}], fields=['foo'] )
+
+
+@skipIf(no_trombi, "not testing Cushion, trombi failed to import")
+class RecordTypeTests(TestCase):
+
+    def test_record_type_cached(self):
+        self.assertTrue(
+            record_type(['a', 'b']) is record_type(('a', 'b')) )
+
+    def test_slots_record(self):
+        rec = record_type(['a', '_id'], 'slots')(1, 'x')
+        self.assertEqual(rec.a, 1)
+        self.assertEqual(rec['_id'], 'x')
+        self.assertFalse(hasattr(rec, '__dict__'))
+
+    def test_tuple_record(self):
+        rec = record_type(['a', '_id'], 'tuple')(1, 'x')
+        self.assertEqual(rec._id, 'x')
+        self.assertEqual(rec['a'], 1)
+        self.assertEqual(tuple(rec), (1, 'x'))
+
+    def test_bad_field_name(self):
+        self.assertRaises(CushionException, record_type, ['no-dashes'])
+
+    def test_reserved_field_name(self):
+        self.assertRaises(CushionException, record_type, ['_fields', 'a'])
+        self.assertRaises(CushionException, record_type, ['__init__'])
+        self.assertRaises(CushionException, record_type, ['a', 'a'])
+        self.assertRaises(CushionException, project, {'a': 1}, ['a', 'a'], 'tuple')
+
+    def test_project(self):
+        doc = {'a': 1, 'b': 2, 'c': 3}
+        self.assertEqual(project(doc, ['a', 'z']), {'a': 1, 'z': None})
+        self.assertEqual(project(doc), doc)
+        self.assertEqual(project(doc, ['c'], 'tuple').c, 3)
+        self.assertRaises(CushionException, project, doc, None, 'slots')
@@ -0,0 +1,201 @@
+import httplib
+import json
+import os
+import select
+import signal
+import socket
+import stat
+import time
+import unittest
+import urllib2
+
+import tornado.ioloop
+import tornado.web
+
+from ..tornado_addons.prefork import merge_stats, reuseport_sockets, serve
+
+
+class PreforkTests(unittest.TestCase):
+
+    def test_merge_stats(self):
+        totals = merge_stats({
+            1: {'pid': 1, 'requests': 3, 'errors': 1, 'request_time': 0.5},
+            2: {'pid': 2, 'requests': 4, 'errors': 0, 'request_time': 0.25},
+            })
+        self.assertEqual(totals, dict(
+            workers=2, requests=7, errors=1, request_time=0.75 ))
+
+    def test_merge_stats_retired(self):
+        totals = merge_stats(
+            {2: {'pid': 2, 'requests': 4, 'errors': 0, 'request_time': 0.25}},
+            {'requests': 3, 'errors': 1, 'request_time': 0.5} )
+        self.assertEqual(totals, dict(
+            workers=1, requests=7, errors=1, request_time=0.75 ))
+
+    def test_merge_stats_empty(self):
+        self.assertEqual(merge_stats({})['workers'], 0)
+
+    def test_reuseport_sockets(self):
+        first = reuseport_sockets(0, '127.0.0.1')
+        if first is None:
+            raise unittest.SkipTest("no SO_REUSEPORT here")
+        port = first[0].getsockname()[1]
+        # a second worker should be able to bind the very same port
+        second = reuseport_sockets(port, '127.0.0.1')
+        try:
+            self.assertEqual(second[0].getsockname()[1], port)
+        finally:
+            for sock in first + second: sock.close()
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class PidHandler(tornado.web.RequestHandler):
+
+    def get(self):
+        from ..tornado_addons import cushion
+        fresh = cushion.pincushion is not STALE_CUSHION and \
+            cushion.pincushion._server.io_loop is \
+            tornado.ioloop.IOLoop.instance()
+        self.write('%d %s' % (os.getpid(), fresh))
+
+class ForkAndDieHandler(tornado.web.RequestHandler):
+    """
+    leaves a grandchild holding the stats pipe open, then kills the worker
+    """
+
+    def get(self):
+        child = os.fork()
+        if not child:
+            # let go of the listening sockets, but not the stats pipe
+            for fd in range(3, 256):
+                try:
+                    if stat.S_ISSOCK(os.fstat(fd).st_mode): os.close(fd)
+                except OSError:
+                    pass
+            time.sleep(30)
+            os._exit(0)
+        self.write(str(child))
+        tornado.ioloop.IOLoop.instance().add_callback(lambda: os._exit(1))
+
+# what a pre fork Cushion would look like to the workers
+STALE_CUSHION = object()
+
+
+class ServeTests(unittest.TestCase):
+    """
+    runs serve(..) in a child process and talks to it over http and a pipe
+    """
+
+    def _serve(self, **ka):
+        r, w = os.pipe()
+        pid = os.fork()
+        if not pid:
+            code = 1
+            try:
+                os.close(r)
+                # serve insists on a pristine IOLoop
+                if hasattr(tornado.ioloop.IOLoop, '_instance'):
+                    del tornado.ioloop.IOLoop._instance
+                from ..tornado_addons import cushion
+                cushion.pincushion = STALE_CUSHION
+                def on_stats(totals, per_worker):
+                    os.write(w, json.dumps([totals, per_worker.keys()]) + '\n')
+                serve(on_stats=on_stats, **ka)
+            except SystemExit, e:
+                code = e.code
+            except RuntimeError:
+                code = 3
+            finally:
+                os._exit(code)
+        os.close(w)
+        self.addCleanup(self._stop, pid)
+        return pid, os.fdopen(r)
+
+    def _stop(self, pid):
+        try: os.kill(pid, signal.SIGTERM)
+        except OSError: pass
+        try: os.waitpid(pid, 0)
+        except OSError: pass
+
+    def _wait_for(self, reports, test, timeout=10):
+        end = time.time() + timeout
+        while time.time() < end:
+            if not select.select([reports], [], [], 1)[0]: continue
+            line = reports.readline()
+            if not line: break
+            totals, pids = json.loads(line)
+            if test(totals, pids): return totals, pids
+        self.fail("never got the stats we wanted")
+
+    def _get(self, port):
+        end = time.time() + 10
+        while True:
+            try:
+                return urllib2.urlopen(
+                    'http://127.0.0.1:%d/pid' % port).read().split()
+            except (urllib2.URLError, socket.error, httplib.HTTPException):
+                if time.time() > end: raise
+                time.sleep(0.05)
+
+    def test_serve_and_restart(self):
+        port = _free_port()
+        pid, reports = self._serve(
+            routes=[('/pid', PidHandler)], port=port, workers=1,
+            address='127.0.0.1', stats_interval=0.1,
+            cushion=dict(uri='http://127.0.0.1:5984') )
+
+        worker, fresh = self._get(port)
+        self.assertEqual(fresh, 'True')
+        totals, pids = self._wait_for(
+            reports, lambda t, p: t['requests'] >= 1)
+        self.assertEqual(pids, [int(worker)])
+        self.assertEqual(totals['workers'], 1)
+
+        os.kill(int(worker), signal.SIGKILL)
+        totals, pids = self._wait_for(
+            reports, lambda t, p: p and p != [int(worker)])
+        # the dead worker's request is still counted
+        self.assertEqual(totals['requests'], 1)
+
+        new_worker, fresh = self._get(port)
+        self.assertNotEqual(new_worker, worker)
+        self.assertEqual(fresh, 'True')
+        self._wait_for(reports, lambda t, p: t['requests'] >= 2)
+
+        os.kill(pid, signal.SIGTERM)
+        self.assertEqual(os.waitpid(pid, 0)[1] >> 8, 0)
+
+    def test_restart_with_pipe_held_open(self):
+        port = _free_port()
+        pid, reports = self._serve(
+            routes=[('/pid', PidHandler), ('/die', ForkAndDieHandler)],
+            port=port, workers=1, address='127.0.0.1', stats_interval=0.1,
+            cushion=dict(uri='http://127.0.0.1:5984') )
+
+        worker, fresh = self._get(port)
+        grandchild = int(urllib2.urlopen(
+            'http://127.0.0.1:%d/die' % port).read())
+        self.addCleanup(os.kill, grandchild, signal.SIGKILL)
+
+        # the supervisor has to get past the dead worker's pipe and restart
+        new_worker, fresh = self._get(port)
+        end = time.time() + 10
+        while new_worker == worker and time.time() < end:
+            time.sleep(0.05)
+            new_worker, fresh = self._get(port)
+        self.assertNotEqual(new_worker, worker)
+        self._wait_for(reports, lambda t, p: p == [int(new_worker)])
+
+    def test_max_restarts(self):
+        # no uri in the cushion settings, so every worker dies on startup
+        pid, reports = self._serve(
+            routes=[], port=_free_port(), workers=1, address='127.0.0.1',
+            cushion=dict(user='nobody'), max_restarts=2 )
+        self.assertEqual(os.waitpid(pid, 0)[1] >> 8, 3)
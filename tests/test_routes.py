@@ -35,3 +35,138 @@ class RouteTests(unittest.TestCase):
         self.assertTrue( t.reverse_url('other') )
 
 
+
+
+class RouteReportTests(unittest.TestCase):
+
+    def setUp(self):
+        # keep whatever other tests registered out of our way
+        self._saved = route.snapshot()
+        route.reset()
+
+        @route('/user/([0-9]+)', name='user')
+        class UserFake(object):
+            pass
+
+        @route('/user/(.*)', name='user_any')
+        class UserAnyFake(object):
+            pass
+
+        @route('/user/42', name='user42')
+        class User42Fake(object):
+            pass
+
+        @route('/about', name='user')
+        class AboutFake(object):
+            pass
+
+        @route('/api/items', name='items')
+        class ItemsFake(object):
+            pass
+
+    def tearDown(self):
+        route.restore(self._saved)
+
+    def test_duplicates(self):
+        self.assertEqual(route.report()['duplicates'], {'user': [0, 3]})
+
+    def test_shadowed(self):
+        # /user/42 is always caught by /user/([0-9]+) first
+        self.assertEqual(route.report()['shadowed'], [(2, 0)])
+
+    def test_specific_before_generic(self):
+        reg = route.registry()
+
+        @reg('/api/v1')
+        class V1Fake(object):
+            pass
+
+        @reg('/api/v([0-9]+)')
+        class VAnyFake(object):
+            pass
+
+        @reg('/api/v([0-9]+)')
+        class VAgainFake(object):
+            pass
+
+        # /api/v2 still reaches the second route, only the copy is shadowed
+        self.assertEqual(reg.report()['shadowed'], [(2, 1)])
+
+    def test_record_hit(self):
+        routes = route.get_routes()
+        self.assertTrue(route.record_hit('/user/7') is routes[0])
+        self.assertTrue(route.record_hit('/user/bob') is routes[1])
+        self.assertEqual(route.record_hit('/nope'), None)
+        self.assertEqual(route.hits(), {routes[0]: 1, routes[1]: 1})
+
+    def test_hits_with_duplicate_names(self):
+        # /user/([0-9]+) and /about are both named 'user', only the first
+        # one gets any traffic
+        for i in range(10):
+            route.record_hit('/user/1')
+        report = route.report()
+        self.assertEqual(report['cost'], 1.0)
+        self.assertEqual(report['hits'][0], (0, 'user', 10))
+        self.assertEqual(report['hits'][3], (3, 'user', 0))
+
+        route.optimize()
+        patterns = [r.regex.pattern for r in route.get_routes()]
+        self.assertEqual(patterns.index('/about$'), 3)
+
+    def test_optimize(self):
+        for i in range(10):
+            route.record_hit('/api/items')
+        route.record_hit('/user/bob')
+
+        report = route.report()
+        self.assertEqual(report['cost'], (5 * 10 + 2) / 11.0)
+        self.assertTrue(report['optimized_cost'] < report['cost'])
+
+        route.optimize()
+        patterns = [r.regex.pattern for r in route.get_routes()]
+        self.assertEqual(patterns[0], '/api/items$')
+        # overlapping user routes keep their relative order
+        self.assertTrue(
+            patterns.index('/user/([0-9]+)$') <
+            patterns.index('/user/(.*)$') <
+            patterns.index('/user/42$') )
+
+
+class RouteRegistryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = route.snapshot()
+
+    def tearDown(self):
+        route.restore(self.saved)
+
+    def test_registry_isolated(self):
+        admin = route.registry()
+
+        @admin('/stats', name='stats')
+        class StatsFake(object):
+            pass
+
+        route_redirect('/st', '/stats', registry=admin)
+
+        self.assertEqual(len(admin.get_routes()), 2)
+        self.assertEqual(route.get_routes(), self.saved[0])
+        t = tornado.web.Application(admin.get_routes(), {})
+        self.assertEqual(t.reverse_url('stats'), '/stats')
+
+    def test_registry_named(self):
+        self.assertTrue(route.registry('x_test') is route.registry('x_test'))
+        self.assertFalse(route.registry() is route.registry())
+
+    def test_snapshot_reset(self):
+        reg = route.registry()
+
+        @reg('/a')
+        class AFake(object):
+            pass
+
+        snap = reg.snapshot()
+        reg.reset()
+        self.assertEqual(reg.get_routes(), [])
+        reg.restore(snap)
+        self.assertEqual(len(reg.get_routes()), 1)
@@ -1,4 +1,8 @@
+import time
+from collections import deque
 from types import GeneratorType
+
+import tornado.ioloop
 import tornado.web
 
 class WrappedCall(object):
@@ -7,10 +11,19 @@ class WrappedCall(object):
         self.a = a
         self.ka = ka
         self.yielding = None
+        self.on_done = None
 
     def _yield_continue(self, response=None):
         try: self.yielding.send(response)
-        except StopIteration: pass
+        except StopIteration: self._done()
+        except:
+            self._done()
+            raise
+
+    def _done(self):
+        if self.on_done:
+            on_done, self.on_done = self.on_done, None
+            on_done()
 
     def yield_cb(self, *args, **ka):
         """
@@ -61,20 +74,169 @@ class WrappedCall(object):
         # obj.yield_cb = self.old_yield_cb
 
 
+class AdmissionController(object):
+    """
+    Caps how many @async_yield generators can be in flight at once and
+    adjusts that cap from the latency it sees (AIMD).  Each generator that
+    finishes under target_latency nudges the limit up by about one per
+    limit's worth of requests; one that's slower cuts it by backoff.
+
+    Requests over the limit wait in a short queue for up to queue_timeout
+    seconds, after which (or if the queue is full) they're rejected.
+
+    A slot is given back when its generator finishes or its request does,
+    whichever comes first.  In case neither happens (a callback that never
+    fires), slots are also taken back after slot_timeout seconds.
+
+    You don't usually make these yourself, see AsyncYieldMixin.admission.
+    """
+
+    def __init__(self, limit=20, min_limit=1, max_limit=200,
+                 target_latency=0.5, backoff=0.9, queue_size=50,
+                 queue_timeout=0.1, slot_timeout=60, io_loop=None):
+        self.limit = float(limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.slot_timeout = slot_timeout
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.expired = 0
+        self.latency = None # moving average, seconds
+        self._queue = deque()
+
+    def admit(self, start, reject):
+        """
+        start(done) gets called once there's room, and has to call done()
+        when it's finished (extra calls are ignored).  reject() gets called
+        instead if there isn't.
+        """
+        if self.in_flight < int(self.limit):
+            self._start(start)
+        elif len(self._queue) < self.queue_size:
+            entry = [start, reject, None]
+            entry[2] = self.io_loop.add_timeout(
+                time.time() + self.queue_timeout,
+                lambda: self._expire(entry) )
+            self._queue.append(entry)
+        else:
+            self.rejected += 1
+            reject()
+
+    def _start(self, start, deferred=False):
+        self.in_flight += 1
+        self.admitted += 1
+        began = time.time()
+        slot = {}
+
+        def done():
+            if slot.get('done'): return
+            slot['done'] = True
+            if 'timeout' in slot: self.io_loop.remove_timeout(slot['timeout'])
+            self._done(time.time() - began)
+
+        def expire():
+            del slot['timeout']
+            self.expired += 1
+            done()
+
+        if self.slot_timeout:
+            slot['timeout'] = self.io_loop.add_timeout(
+                began + self.slot_timeout, expire )
+
+        if deferred:
+            # don't run somebody else's request on the finishing one's stack
+            self.io_loop.add_callback(lambda: start(done))
+        else:
+            start(done)
+
+    def _expire(self, entry):
+        self._queue.remove(entry)
+        self.timed_out += 1
+        self.rejected += 1
+        entry[1]()
+
+    def _done(self, latency):
+        self.in_flight -= 1
+        if self.latency is None: self.latency = latency
+        else: self.latency = 0.9 * self.latency + 0.1 * latency
+
+        if latency > self.target_latency:
+            self.limit = max(self.min_limit, self.limit * self.backoff)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+
+        while self._queue and self.in_flight < int(self.limit):
+            start, reject, timeout = self._queue.popleft()
+            self.io_loop.remove_timeout(timeout)
+            self._start(start, deferred=True)
+
+    def stats(self):
+        return dict(
+            limit=int(self.limit),
+            in_flight=self.in_flight,
+            queued=len(self._queue),
+            admitted=self.admitted,
+            rejected=self.rejected,
+            timed_out=self.timed_out,
+            expired=self.expired,
+            latency=self.latency )
+
+
+# one AdmissionController per handler class, see AsyncYieldMixin.admission
+_controllers = {}
+
+def _admission_for(obj):
+    settings = getattr(obj, 'admission', None)
+    if not settings or getattr(obj, '_admitted', False):
+        # not limited, or we're nested inside an already admitted generator
+        return None
+    cls = type(obj)
+    if cls not in _controllers:
+        _controllers[cls] = AdmissionController(**settings)
+    return _controllers[cls]
+
+
+def _run_wrapped(f, a, ka, on_done=None):
+    call = WrappedCall(f, *a, **ka)
+    call.on_done = on_done
+    with call as f_:
+        if type(f_) is not GeneratorType:
+            print "F_ not a generator", f_
+            call._done()
+            return f_
+
+        print "F_ gen", f_
+        try: 
+            f_.next() # kickstart it
+            print "f_ went", f_
+        except StopIteration:
+            print "STOP ITER", f_
+            call._done()
+        except:
+            call._done()
+            raise
+
+
 def async_yield(f):
     def yielding_(*a, **ka):
-        with WrappedCall(f, *a, **ka) as f_:
-            if type(f_) is not GeneratorType:
-                print "F_ not a generator", f_
-                return f_
-
-            print "F_ gen", f_
-            try: 
-                f_.next() # kickstart it
-                print "f_ went", f_
-            except StopIteration:
-                print "STOP ITER", f_
-                pass
+        obj = a[0] if a else None
+        ctl = _admission_for(obj)
+        if not ctl:
+            return _run_wrapped(f, a, ka)
+
+        def start(done):
+            obj._admitted = True
+            obj._admission_done = done
+            _run_wrapped(f, a, ka, done)
+        ctl.admit(start, lambda: obj.send_error(503))
 
     return yielding_
 
@@ -83,6 +245,38 @@ class AsyncYieldMixin(tornado.web.RequestHandler):
 
     yield_cb = lambda *a, **ka: None
 
+    # Set this to a dict of AdmissionController arguments to cap how many
+    # @async_yield generators this handler class runs at once, e.g.
+    #   admission = dict(limit=20, target_latency=0.25)
+    # Requests over the cap are queued briefly then answered with a 503.
+    # Only the outermost generator of each request counts.
+    admission = None
+
+    @classmethod
+    def admission_stats(cls):
+        """
+        queue and rejection counters for this handler class, or None if it
+        isn't limited (or hasn't seen a request yet)
+        """
+        ctl = _controllers.get(cls)
+        return ctl.stats() if ctl else None
+
+    def _release_admission(self):
+        # the request's over, so its slot is too, even if its generator
+        # never got resumed
+        done = getattr(self, '_admission_done', None)
+        if done:
+            self._admission_done = None
+            done()
+
+    def on_finish(self):
+        self._release_admission()
+        super(AsyncYieldMixin, self).on_finish()
+
+    def on_connection_close(self):
+        self._release_admission()
+        super(AsyncYieldMixin, self).on_connection_close()
+
     def prepare(self):
         self._yield_callbacks = {}
         super(AsyncYieldMixin, self).prepare()
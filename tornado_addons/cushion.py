@@ -1,6 +1,13 @@
+import json
 import logging
+import re
+import time
 import trombi
+import trombi.client
 
+from operator import itemgetter
+
+import tornado.gen
 import tornado.ioloop
 
 
@@ -18,6 +25,102 @@ class CushionDBNotReady(Exception):
     pass
 
 
+_field_re = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+# names the record classes use for themselves
+_reserved_fields = ('_fields',)
+_record_types = {}
+
+def record_type(fields, kind='slots'):
+    """
+    Build (or fetch from cache) a compact record class for a set of fields.
+
+    kind='slots' returns a class using __slots__, so instances carry no
+    per-instance __dict__.  kind='tuple' returns a tuple subclass with named
+    read-only accessors, which is the smallest option but immutable.  Both
+    support rec['field'] as well as rec.field so they can stand in for the
+    dicts handed back by default.
+    """
+    fields = tuple(fields)
+    cache_key = (fields, kind)
+    if cache_key in _record_types:
+        return _record_types[cache_key]
+
+    if len(set(fields)) != len(fields):
+        raise CushionException("duplicate field names in %r" % (fields,))
+    for f in fields:
+        if not _field_re.match(f) or f in _reserved_fields \
+                or f.startswith('__'):
+            raise CushionException(
+                "can't build a record with field name %r" % f )
+
+    if kind == 'slots':
+        def __init__(self, *values):
+            for f, v in zip(fields, values):
+                setattr(self, f, v)
+        def __getitem__(self, key):
+            return getattr(self, key)
+        def __repr__(self):
+            return 'Record(%s)' % ', '.join(
+                '%s=%r' % (f, getattr(self, f)) for f in fields )
+        attrs = dict(
+            __slots__=fields,
+            __init__=__init__,
+            __getitem__=__getitem__,
+            __repr__=__repr__ )
+        cls = type('Record', (object,), attrs)
+    elif kind == 'tuple':
+        def __new__(cls, *values):
+            return tuple.__new__(cls, values)
+        def __getitem__(self, key):
+            if isinstance(key, basestring):
+                return getattr(self, key)
+            return tuple.__getitem__(self, key)
+        attrs = dict(
+            __slots__=(),
+            __new__=__new__,
+            __getitem__=__getitem__ )
+        for i, f in enumerate(fields):
+            attrs[f] = property(itemgetter(i))
+        cls = type('TupleRecord', (tuple,), attrs)
+    else:
+        raise CushionException("unknown record kind %r" % kind)
+
+    cls._fields = fields
+    _record_types[cache_key] = cls
+    return cls
+
+
+def project(data, fields=None, record=None):
+    """
+    Pull just `fields` out of a document dict.  Missing fields come back as
+    None.  If record is 'slots' or 'tuple', the result is an instance of the
+    matching record_type instead of a dict.
+    """
+    if data is None:
+        return None
+    if not fields:
+        if record:
+            raise CushionException("record types need an explicit fields list")
+        return data
+    if record:
+        return record_type(fields, record)(*[data.get(f) for f in fields])
+    return dict((f, data.get(f)) for f in fields)
+
+
+def design_changed(current, wanted):
+    """
+    True if the design doc in the db (current, may be None) differs from the
+    one we want to push.  _id and _rev are ignored.
+    """
+    if not current: return True
+    strip = lambda d: dict(
+        (k, v) for k, v in d.items() if k not in ('_id', '_rev') )
+    return strip(current) != strip(wanted)
+
+
+# sync_designs builds new indexes under this id before swapping them live
+_STAGING_SUFFIX = '__new'
+
 pincushion = None
 
 class Cushion(object):
@@ -35,11 +138,27 @@ class Cushion(object):
             pincushion = Cushion(uri, user, password, **ka)
         return pincushion
 
+    @classmethod
+    def reset(self):
+        """
+        Forget the global pincushion and every open database.  Call this in a
+        child process after fork since the parent's connections are tied to
+        the parent's IOLoop.
+        """
+        global pincushion
+        pincushion = None
+        self._pool.clear()
+
     def __init__(self, uri, user=None, password=None, **ka):
+        # any extra ka (io_loop, max_clients, ...) goes through trombi to the
+        # AsyncHTTPClient, which every database in our pool shares
         self._server = trombi.Server(
             uri,
             fetch_args=dict(auth_username=user, auth_password=password),
             **ka)
+        self.tasks = CushionTasks(self)
+        # (dbname, design) pairs whose indexes are still building
+        self._warming = set()
 
     def create(self, dbname, callback):
         """
@@ -110,7 +229,7 @@ class Cushion(object):
     def __contains__(self, dbname):
         return dbname in self._pool
 
-    def one(self, db, _id, cb, **ka):
+    def one(self, db, _id, callback, **ka):
         """
         Convenience method to fetch one object by id from the specified
         database.
@@ -119,15 +238,20 @@ class Cushion(object):
         ==========
         db -> db name as str
         _id -> key of document to fetch as str
-        cb -> function ptr to callback
+        callback -> function ptr to callback
+        fields -> optional list of field names to keep from the document
+        record -> optional 'slots' or 'tuple' to get a compact record back
+            instead of a dict (requires fields)
         ka -> keyword arguments
         """
+        fields = ka.pop('fields', None)
+        record = ka.pop('record', None)
         def _cb(doc):
-            cb(doc.raw() if doc else None)
+            callback(project(doc.raw(), fields, record) if doc else None)
         # note, this is calling the .get method on a trombi Database obj
         self.get(db).get(_id, _cb, **ka)
 
-    def view(self, db, resource, cb, **ka):
+    def view(self, db, resource, callback, **ka):
         """
         Convenience method to fetch the results of a view from a specific
         database.
@@ -136,12 +260,276 @@ class Cushion(object):
         db -> db name as str
         resource -> string of the resource 'designDocName/resourceName'
             or '/resourceName' to hit the special view '_alldocs'
-        cb -> function ptr to callback
+        callback -> function ptr to callback
+        fields -> optional list of field names.  When given, the callback gets
+            a list with one projected record per row instead of the trombi
+            view result.  Fields are taken from the row's doc when
+            include_docs=True, otherwise from the emitted value.
+        record -> optional 'slots' or 'tuple', see one(..)
         ka -> keyword arguments
         """
+        fields = ka.pop('fields', None)
+        record = ka.pop('record', None)
         des, res = resource.split('/')
+        if fields:
+            cb_ = callback
+            def callback(result):
+                if result.error:
+                    # let the caller see the error as trombi reported it
+                    cb_(result)
+                    return
+                records = []
+                for row in result:
+                    data = row.get('doc') or row.get('value')
+                    if data is not None and not isinstance(data, dict):
+                        raise CushionException(
+                            "can't pick fields out of %r from view %s, emit "
+                            "documents or use include_docs=True" % (
+                                data, resource) )
+                    records.append(project(data or {}, fields, record))
+                cb_(records)
+        elif record:
+            raise CushionException("record types need an explicit fields list")
         # note, this is calling the .view method on a trombi Database obj
-        self.get(db).view(des, res, cb, **ka)
+        self.get(db).view(des, res, callback, **ka)
+
+    def many(self, db, keys, callback, **ka):
+        """
+        Convenience method to fetch a list of documents by id in one request
+        to _all_docs.  The callback gets a list of docs in the same order as
+        keys, with None for any that aren't there.
+
+        Parameters
+        ==========
+        db -> db name as str
+        keys -> list of document ids
+        callback -> function ptr to callback
+        fields, record -> see one(..)
+        ka -> keyword arguments passed on to the view
+        """
+        fields = ka.pop('fields', None)
+        record = ka.pop('record', None)
+        def _cb(result):
+            if result.error:
+                callback(result)
+                return
+            callback([ project(row.get('doc'), fields, record)
+                       for row in result ])
+        self.get(db).view('', '_all_docs', _cb,
+            keys=keys, include_docs=True, **ka)
+
+    def sync_designs(self, dbnames, designs, callback=None, concurrency=10,
+                     progress=None, warm=True, poll_interval=5,
+                     build_timeout=3600):
+        """
+        Push design documents to a bunch of databases with their indexes
+        built before anybody queries them.
+
+        Only designs that differ from what's in the db get touched.  With
+        warm=True (the default) a changed design goes out under a staging id,
+        _design/<name>__new, and one of its views is queried with
+        stale=update_after so couch builds the index in the background.
+        Meanwhile the live design and its old index keep answering view(..)
+        calls with correct results.  Once the staging design's _info says the
+        build is done, the live design is overwritten with the new one in
+        the same _bulk_docs request that deletes the staging copy.  Couch
+        keys indexes on the view code, not the doc id, so the live design
+        picks up the already built index.
+
+        At most `concurrency` dbs are worked on at once, and a db holds its
+        slot from the first push until its swap.  That caps both the number
+        of index builds running and the _info polling.
+
+        Parameters
+        ==========
+        dbnames -> list of db names
+        designs -> dict of design name to design doc (no _id/_rev needed),
+            i.e. {'users': {'language': 'javascript',
+                            'views': {'by_email': {'map': '...'}}}}
+        callback -> called with {'updated': [...], 'unchanged': [...],
+            'errors': {dbname: msg}} once every db is done
+        progress -> called with (done, total, dbname) after each db
+        warm -> False to write changed designs straight to their live ids
+            and leave the index build to whoever queries them first
+        poll_interval -> seconds between checks on building indexes, see
+            warming()
+        build_timeout -> seconds to wait on a db's index builds before giving
+            up on it and reporting it in errors.  The live design is left
+            alone, so a design that never builds (say its map function
+            doesn't compile) can't hold a concurrency slot forever.
+        """
+        dbnames = list(dbnames)
+        queue = list(reversed(dbnames))
+        summary = dict(updated=[], unchanged=[], errors={})
+        state = dict(running=0, done=0, called=False)
+
+        def finished(dbname, changed, error=None):
+            if error:
+                logging.error("sync_designs %s: %s" % (dbname, error))
+                summary['errors'][dbname] = error
+            elif changed:
+                summary['updated'].append(dbname)
+            else:
+                summary['unchanged'].append(dbname)
+            state['done'] += 1
+            state['running'] -= 1
+            if progress: progress(state['done'], len(dbnames), dbname)
+            next_()
+
+        def next_():
+            while queue and state['running'] < concurrency:
+                state['running'] += 1
+                self._sync_db(
+                    queue.pop(), designs, finished, warm, poll_interval,
+                    build_timeout)
+            if not state['running'] and not state['called']:
+                state['called'] = True
+                if callback: callback(summary)
+
+        next_()
+
+    def _sync_db(self, dbname, designs, finished, warm, poll_interval,
+                 build_timeout):
+        live = lambda name: '_design/' + name
+        staging = lambda name: '_design/' + name + _STAGING_SUFFIX
+        io_loop = self._server.io_loop or tornado.ioloop.IOLoop.instance()
+        state = {}
+
+        def fail(msg):
+            if state.get('failed'): return
+            state['failed'] = True
+            for name in state.get('staged', ()):
+                self._warming.discard((dbname, name))
+            finished(dbname, None, msg)
+
+        def fetch_designs(db, names, then):
+            ids = [live(n) for n in names] + [staging(n) for n in names]
+            def got(result):
+                if result.error: fail(result.msg)
+                else: then(dict(
+                    (row['key'], row.get('doc')) for row in result
+                    if 'key' in row ))
+            db.view('', '_all_docs', got, keys=ids, include_docs=True)
+
+        def bulk(db, docs, then):
+            def pushed(result):
+                if result.error:
+                    fail(result.msg)
+                    return
+                errors = [r.reason or r.error_type for r in result
+                          if isinstance(r, trombi.client.BulkError)]
+                if errors: fail(', '.join(errors))
+                else: then()
+            db.bulk_docs(docs, pushed)
+
+        def live_doc(name, current):
+            doc = dict(designs[name], _id=live(name))
+            have = current.get(live(name))
+            if have: doc['_rev'] = have['_rev']
+            return doc
+
+        def got_db(db):
+            if db.error:
+                fail(db.msg)
+                return
+            fetch_designs(db, designs.keys(), lambda current: push(db, current))
+
+        def push(db, current):
+            changed = [ name for name in designs if design_changed(
+                current.get(live(name)), dict(designs[name], _id=live(name)) ) ]
+            if not changed:
+                finished(dbname, [])
+                return
+            state['changed'] = changed
+
+            docs, staged = [], []
+            for name in changed:
+                if not warm or not designs[name].get('views'):
+                    # nothing to build ahead of time
+                    docs.append(live_doc(name, current))
+                    continue
+                # only the bits couch builds the index from, so things like
+                # validate_doc_update don't go into effect early
+                doc = dict(
+                    (k, v) for k, v in designs[name].items()
+                    if k in ('language', 'views', 'options') )
+                doc['_id'] = staging(name)
+                have = current.get(staging(name))
+                if have: doc['_rev'] = have['_rev']
+                docs.append(doc)
+                staged.append(name)
+            state['staged'] = staged
+
+            if staged: bulk(db, docs, lambda: build(db))
+            else: bulk(db, docs, lambda: finished(dbname, changed))
+
+        def kicked_off(response, name):
+            if response.code != 200:
+                fail("building %s: %s" % (
+                    staging(name),
+                    trombi.client._error_response(response).msg ))
+
+        def build(db):
+            for name in state['staged']:
+                self._warming.add((dbname, name))
+                db._fetch(
+                    '%s/_view/%s?limit=0&stale=update_after' % (
+                        staging(name), sorted(designs[name]['views'])[0] ),
+                    lambda response, name=name: kicked_off(response, name) )
+            state['pending'] = set(state['staged'])
+            state['deadline'] = time.time() + build_timeout
+            io_loop.add_timeout(time.time() + poll_interval, lambda: poll(db))
+
+        def poll(db):
+            if state.get('failed'): return
+            waiting = dict(count=len(state['pending']))
+            def got_info(response, name):
+                if state.get('failed'): return
+                if response.code != 200:
+                    fail(trombi.client._error_response(response).msg)
+                    return
+                info = json.loads(response.body).get('view_index', {})
+                # update_seq stays 0 until the updater has actually run
+                if info.get('update_seq') and not info.get('updater_running'):
+                    state['pending'].discard(name)
+                waiting['count'] -= 1
+                if waiting['count']: return
+                if state['pending'] and time.time() > state['deadline']:
+                    fail("index build for %s didn't finish in %ss" % (
+                        ', '.join(sorted(state['pending'])), build_timeout ))
+                elif state['pending']:
+                    io_loop.add_timeout(
+                        time.time() + poll_interval, lambda: poll(db))
+                else:
+                    fetch_designs(
+                        db, state['staged'], lambda current: swap(db, current))
+            for name in list(state['pending']):
+                db._fetch(
+                    '%s/_info' % staging(name),
+                    lambda response, name=name: got_info(response, name) )
+
+        def swap(db, current):
+            docs = []
+            for name in state['staged']:
+                docs.append(live_doc(name, current))
+                have = current.get(staging(name))
+                if have: docs.append(dict(
+                    _id=staging(name), _rev=have['_rev'], _deleted=True ))
+            def swapped():
+                for name in state['staged']:
+                    self._warming.discard((dbname, name))
+                finished(dbname, state['changed'])
+            bulk(db, docs, swapped)
+
+        if dbname in self: got_db(self.get(dbname))
+        else: self._server.get(name=dbname, callback=got_db, create=False)
+
+    def warming(self):
+        """
+        (dbname, design) pairs that sync_designs(..) is building an index
+        for and hasn't swapped live yet
+        """
+        return set(self._warming)
 
     def save(self, db, data, callback=None):
         """saves dict to couchdb"""
@@ -170,6 +558,40 @@ class Cushion(object):
                 )
 
 
+class CushionTasks(object):
+    """
+    Wraps a Cushion so its calls can be yielded from a tornado.gen coroutine
+    instead of handing in callbacks.  Every Cushion has one as .tasks
+
+        @tornado.web.asynchronous
+        @tornado.gen.engine
+        def get(self):
+            tasks = self.cushion.tasks
+            user = yield tasks.one('accounts', user_id)
+            # a list runs them all at once and waits for every result
+            prefs, hist = yield [
+                tasks.one('prefs', user_id),
+                tasks.view('history', 'by_user/all', key=user_id) ]
+
+    Each call returns a tornado.gen.Task, which is a YieldPoint for
+    gen.engine and not something you can await.
+    """
+
+    _methods = ('open', 'exists', 'one', 'many', 'view', 'save', 'delete')
+
+    def __init__(self, cushion):
+        self._cushion = cushion
+
+    def __getattr__(self, name):
+        if name not in self._methods:
+            raise AttributeError(name)
+        func = getattr(self._cushion, name)
+        def task(*a, **ka):
+            return tornado.gen.Task(func, *a, **ka)
+        task.__name__ = name
+        return task
+
+
 class CushionDBMixin(object):
 
     def prepare(self):
@@ -239,6 +661,8 @@ class CushionDBMixin(object):
                 block until we get that connection.
         key <-  the key of our document, a string.
         callback <- None or a function to call upon completion.
+        fields <- optional list of fields to keep, see Cushion.one
+        record <- optional 'slots' or 'tuple' record type, see Cushion.one
         **  any other remaining kwargs will be passed through to cushion's .one
             call, which passes them to trombi.
         """
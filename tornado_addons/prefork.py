@@ -0,0 +1,265 @@
+"""
+Pre-fork a tornado app across a handful of processes.
+
+Handler modules get imported once in the parent so the route table is built
+a single time, then each worker inherits it through fork.  Workers open their
+own listening socket with SO_REUSEPORT where the OS has it (so the kernel
+spreads connections across them) and fall back to sockets bound in the parent
+and shared by everybody where it doesn't.  If you hand in cushion settings,
+each worker gets a fresh Cushion built on its own IOLoop after the fork.
+
+    import handlers  # fills up route
+    from tornado_addons.route import route
+    from tornado_addons.prefork import serve
+
+    serve(route.get_routes(), 8888, workers=4,
+          cushion=dict(uri='http://localhost:5984', max_clients=20))
+
+Workers report their stats up a pipe every stats_interval seconds.  The
+parent adds them up and hands them to on_stats(totals, per_worker), or logs
+them if you don't give it one.  Workers that die get restarted.
+"""
+
+import errno
+import fcntl
+import json
+import logging
+import os
+import random
+import select
+import signal
+import socket
+import sys
+
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+import tornado.process
+import tornado.web
+
+# python 2 doesn't export the constant even where the kernel has it
+SO_REUSEPORT = getattr(
+    socket, 'SO_REUSEPORT',
+    15 if sys.platform.startswith('linux') else None )
+
+# stats fields that get summed across workers
+_SUMMED = ('requests', 'errors', 'request_time')
+
+
+def reuseport_sockets(port, address=None, backlog=128):
+    """
+    Bind listening sockets with SO_REUSEPORT set.  Returns None if the
+    platform won't let us, in which case the caller should share sockets.
+    """
+    if SO_REUSEPORT is None:
+        return None
+    sockets = []
+    try:
+        for res in socket.getaddrinfo(address or None, port, socket.AF_INET,
+                                      socket.SOCK_STREAM, 0,
+                                      socket.AI_PASSIVE):
+            af, socktype, proto, canonname, sockaddr = res
+            sock = socket.socket(af, socktype, proto)
+            sockets.append(sock)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+            sock.setblocking(0)
+            sock.bind(sockaddr)
+            sock.listen(backlog)
+    except socket.error, e:
+        for sock in sockets: sock.close()
+        if e.args[0] in (errno.ENOPROTOOPT, errno.EINVAL):
+            return None
+        raise
+    return sockets
+
+
+def merge_stats(per_worker, retired=None):
+    """
+    add up the latest stats from every worker, plus whatever the workers
+    that have since died (retired) last reported
+    """
+    totals = dict((k, 0) for k in _SUMMED)
+    totals['workers'] = len(per_worker)
+    for stats in per_worker.values() + [retired or {}]:
+        for k in _SUMMED:
+            totals[k] += stats.get(k, 0)
+    return totals
+
+
+class _WorkerStats(object):
+    """
+    counts requests as tornado logs them, then ships the totals to the
+    parent over a pipe
+    """
+
+    def __init__(self, fd, log_function=None):
+        self.fd = fd
+        self.log_function = log_function
+        self.stats = dict((k, 0) for k in _SUMMED)
+        self.stats['pid'] = os.getpid()
+
+    def __call__(self, handler):
+        self.stats['requests'] += 1
+        if handler.get_status() >= 500:
+            self.stats['errors'] += 1
+        self.stats['request_time'] += handler.request.request_time()
+        if self.log_function: self.log_function(handler)
+
+    def report(self):
+        try:
+            os.write(self.fd, json.dumps(self.stats) + '\n')
+        except OSError, e:
+            # parent's gone, nobody to tell
+            if e.errno != errno.EPIPE: raise
+
+
+def _run_worker(routes, port, address, settings, cushion, shared,
+                stats_fd, stats_interval):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    # don't hand every worker the same random sequence
+    random.seed()
+    io_loop = tornado.ioloop.IOLoop.instance()
+
+    if cushion:
+        from .cushion import Cushion
+        Cushion.reset()
+        cushion = dict(cushion)
+        Cushion.new(cushion.pop('uri'), io_loop=io_loop, **cushion)
+
+    stats = _WorkerStats(stats_fd, settings.get('log_function'))
+    settings = dict(settings, log_function=stats)
+    app = tornado.web.Application(routes, **settings)
+
+    server = tornado.httpserver.HTTPServer(app, io_loop=io_loop)
+    server.add_sockets(shared or reuseport_sockets(port, address))
+    tornado.ioloop.PeriodicCallback(
+        stats.report, stats_interval * 1000, io_loop=io_loop).start()
+    io_loop.start()
+
+
+def serve(routes, port, workers=None, address=None, settings=None,
+          cushion=None, stats_interval=5, on_stats=None, max_restarts=100):
+    """
+    Fork workers serving routes on port and babysit them.  This never
+    returns normally: SIGTERM or SIGINT in the parent raises SystemExit(0)
+    out of here, and RuntimeError is raised after max_restarts.  Either way
+    the workers are taken down too.
+
+    routes -> the list for tornado.web.Application, usually route.get_routes()
+    workers -> number of processes, defaults to one per cpu
+    settings -> dict of Application settings
+    cushion -> dict of Cushion.new arguments (uri plus any extras such as
+        user, password or max_clients) to set one up in each worker
+    stats_interval -> seconds between worker stats reports
+    on_stats -> called with (totals, {pid: stats}) every time a report comes
+        in.  totals keep counting what dead workers had reported, so they
+        never go backwards.  Defaults to logging the totals.
+    max_restarts -> give up (RuntimeError) after restarting this many workers
+    """
+    if tornado.ioloop.IOLoop.initialized():
+        raise RuntimeError(
+            "the IOLoop has already been created, workers can't share it. "
+            "call serve(..) before touching IOLoop.instance()" )
+
+    workers = workers or tornado.process.cpu_count()
+    settings = settings or {}
+    on_stats = on_stats or (lambda totals, _: logging.info(
+        "prefork stats %s", json.dumps(totals, sort_keys=True)))
+
+    # only bind up front if every worker can't get its own socket
+    probe = reuseport_sockets(port, address)
+    if probe is None:
+        shared = tornado.netutil.bind_sockets(port, address)
+    else:
+        shared = None
+        for sock in probe: sock.close()
+
+    children = {}   # pid -> read end of its stats pipe
+    per_worker = {} # pid -> latest stats
+    retired = dict((k, 0) for k in _SUMMED) # last stats of dead workers
+    buffers = {}
+    restarts = [0]
+
+    def spawn():
+        r, w = os.pipe()
+        pid = os.fork()
+        if not pid:
+            # never let the child fall back into the parent's loop below
+            try:
+                os.close(r)
+                for fd in children.values(): os.close(fd)
+                # keep anything the worker execs from holding our pipe open
+                fcntl.fcntl(w, fcntl.F_SETFD,
+                            fcntl.fcntl(w, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+                _run_worker(routes, port, address, settings, cushion, shared,
+                            w, stats_interval)
+            except:
+                logging.exception("prefork worker died")
+            finally:
+                os._exit(1)
+        os.close(w)
+        # a forked grandchild can still hold the write end after the worker
+        # dies, so never block waiting for EOF on it
+        fcntl.fcntl(r, fcntl.F_SETFL,
+                    fcntl.fcntl(r, fcntl.F_GETFL) | os.O_NONBLOCK)
+        children[pid] = r
+        buffers[r] = ''
+
+    def read_stats(fd):
+        try:
+            data = os.read(fd, 65536)
+        except OSError, e:
+            if e.errno == errno.EAGAIN: return False
+            raise
+        if not data: return False
+        lines = (buffers[fd] + data).split('\n')
+        buffers[fd] = lines.pop()
+        for line in lines:
+            stats = json.loads(line)
+            per_worker[stats['pid']] = stats
+            on_stats(merge_stats(per_worker, retired), per_worker)
+        return True
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(workers): spawn()
+
+    try:
+        while True:
+            try:
+                readable, _, _ = select.select(children.values(), [], [], 1)
+            except select.error, e:
+                if e.args[0] == errno.EINTR: continue
+                raise
+            for fd in readable: read_stats(fd)
+
+            # restart anything that's fallen over
+            while children:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if not pid: break
+                logging.warning("prefork worker %d exited with %d, restarting",
+                                pid, status)
+                fd = children.pop(pid)
+                # pick up anything it said on the way out
+                while read_stats(fd): pass
+                os.close(fd)
+                del buffers[fd]
+                last = per_worker.pop(pid, {})
+                for k in _SUMMED: retired[k] += last.get(k, 0)
+                restarts[0] += 1
+                if restarts[0] > max_restarts:
+                    raise RuntimeError("too many prefork worker restarts")
+                spawn()
+    finally:
+        for pid in children:
+            try: os.kill(pid, signal.SIGTERM)
+            except OSError: pass
+        for pid in children:
+            try: os.waitpid(pid, 0)
+            except OSError: pass
@@ -1,5 +1,10 @@
 import tornado.web
 
+# sample values plugged into a url's groups when checking if two routes can
+# match the same path.  url regexes aren't something we can compare directly,
+# so we make up some paths and see who matches them.
+_SAMPLE_ARGS = ('1', '2', '123', 'x', 'xy', 'x1', 'x-1', 'x/y', '')
+
 class route(object):
     """
     decorates RequestHandlers and builds up a list of routables handlers
@@ -35,6 +40,22 @@ class route(object):
 
     my_routes = route.get_routes()
 
+    Separate Registries
+    -------------------
+
+    Every @route lands in the same process wide list.  If you need more than
+    one Application in a process (say a public api and an admin port), make a
+    registry for each and decorate with it instead.  It's just a subclass of
+    route with its own list, so everything here works on it the same way.
+
+    admin_route = route.registry('admin')
+
+    @admin_route('/stats')
+    class StatsHandler(RequestHandler):
+        pass
+
+    admin_app = Application(admin_route.get_routes())
+
     Credit
     -------
     Jeremy Kelley - initial work
@@ -43,6 +64,8 @@ class route(object):
     """
 
     _routes = []
+    _hits = {}
+    _registries = {}
 
     def __init__(self, uri, name=None):
         self._uri = uri
@@ -58,6 +81,192 @@ class route(object):
     def get_routes(self):
         return self._routes
 
+    @classmethod
+    def registry(self, name=None):
+        """
+        Returns the route registry called name, creating it if needed.  With
+        no name you get a brand new anonymous registry every time, which is
+        what you want in tests.
+        """
+        if name and name in route._registries:
+            return route._registries[name]
+        reg = type(
+            'route_' + (name or 'anon'), (route,),
+            dict(_routes=[], _hits={}) )
+        if name: route._registries[name] = reg
+        return reg
+
+    @classmethod
+    def snapshot(self):
+        """
+        grab a copy of this registry's state to hand to restore(..) later
+        """
+        return self._routes[:], dict(self._hits)
+
+    @classmethod
+    def restore(self, snap):
+        routes, hits = snap
+        self._routes[:] = routes
+        self._hits.clear()
+        self._hits.update(hits)
+
+    @classmethod
+    def reset(self):
+        """empty out this registry"""
+        self.restore(([], {}))
+
+    @classmethod
+    def record_hit(self, path):
+        """
+        Count a request for path against the route tornado would dispatch it
+        to.  Hook it into the application's log_function to gather stats:
+
+            def log_req(handler):
+                route.record_hit(handler.request.path)
+                ...
+            Application(route.get_routes(), log_function=log_req)
+
+        This re-runs the match, so it's meant for sampling or staging, not
+        something you'll want on every request forever.
+        """
+        for spec in self._routes:
+            if spec.regex.match(path):
+                self._hits[spec] = self._hits.get(spec, 0) + 1
+                return spec
+        return None
+
+    @classmethod
+    def hits(self):
+        """
+        returns the hit counts keyed by the url objects in get_routes().
+        Names aren't unique (that's one of the things report(..) looks for),
+        so they'd lump different routes together.
+        """
+        return dict(self._hits)
+
+    @classmethod
+    def report(self, hits=None):
+        """
+        Analyze the registered routes.  Returns a dict with:
+
+        duplicates -> {name: [index, ...]} for names used more than once
+        shadowed -> [(index, shadowing_index), ...] routes that an earlier
+            route always catches first, so they can never be reached
+        cost -> average number of regexes evaluated per request given the
+            hit counts (None if there are no hits)
+        optimized_cost -> same, if the routes were ordered by optimize(..)
+        order -> the suggested ordering as indexes into get_routes()
+        hits -> [(index, name or pattern, count), ...] for every route
+
+        Shadowing is worked out by plugging sample values into each url and
+        seeing which earlier routes match, so it's a good hint rather than a
+        proof.  A route with groups is only reported if it takes at least two
+        different samples and the earlier route catches all of them, and
+        never because of an earlier plain literal (that's the usual
+        specific-before-generic layout).  Routes we can't reverse are never
+        reported as shadowed.
+        """
+        routes = self._routes
+        if hits is None: hits = self._hits
+
+        names = {}
+        for i, spec in enumerate(routes):
+            if spec.name:
+                names.setdefault(spec.name, []).append(i)
+        duplicates = dict((n, ix) for n, ix in names.items() if len(ix) > 1)
+
+        shadowed = []
+        for i, spec in enumerate(routes):
+            samples = _sample_paths(spec)
+            if not samples: continue
+            if spec.regex.groups and len(set(samples)) < 2: continue
+            for j in range(i):
+                if spec.regex.groups and not routes[j].regex.groups:
+                    # a literal can only take one of our paths
+                    continue
+                if all(routes[j].regex.match(p) for p in samples):
+                    shadowed.append((i, j))
+                    break
+
+        order = _optimized_order(routes, hits)
+        return dict(
+            duplicates=duplicates,
+            shadowed=shadowed,
+            cost=_match_cost(routes, hits),
+            optimized_cost=_match_cost([routes[i] for i in order], hits),
+            order=order,
+            hits=[ (i, _route_label(s), hits.get(s, 0))
+                   for i, s in enumerate(routes) ] )
+
+    @classmethod
+    def optimize(self, hits=None):
+        """
+        Reorder the registered routes in place so the most frequently hit
+        ones are tried first.  A route is only moved ahead of another if the
+        two can't match the same path, so dispatch results don't change.
+
+        Call this before handing get_routes() to an Application, tornado
+        copies the list when the Application is built.
+        """
+        if hits is None: hits = self._hits
+        order = _optimized_order(self._routes, hits)
+        self._routes[:] = [self._routes[i] for i in order]
+        return self._routes
+
+
+def _route_label(spec):
+    return spec.name or spec.regex.pattern
+
+
+def _sample_paths(spec):
+    """
+    make up some paths that spec matches. returns [] if we can't.
+    """
+    if spec._path is None: return []
+    if not spec._group_count:
+        candidates = [spec._path]
+    else:
+        candidates = [
+            spec._path % ((a,) * spec._group_count) for a in _SAMPLE_ARGS ]
+    return [p for p in candidates if spec.regex.match(p)]
+
+
+def _overlaps(a, b):
+    """
+    True if a and b might match the same path.  When we can't tell, we assume
+    they do since that's the safe answer for reordering.
+    """
+    sa, sb = _sample_paths(a), _sample_paths(b)
+    if not sa or not sb: return True
+    return any(b.regex.match(p) for p in sa) or \
+           any(a.regex.match(p) for p in sb)
+
+
+def _match_cost(routes, hits):
+    total = sum(hits.get(s, 0) for s in routes)
+    if not total: return None
+    return sum(
+        (i + 1) * hits.get(s, 0)
+        for i, s in enumerate(routes) ) / float(total)
+
+
+def _optimized_order(routes, hits):
+    """
+    stable bubble of busier routes towards the front, never hopping over a
+    route they overlap with
+    """
+    order = range(len(routes))
+    count = lambda i: hits.get(routes[i], 0)
+    moved = True
+    while moved:
+        moved = False
+        for k in range(len(order) - 1):
+            a, b = order[k], order[k + 1]
+            if count(b) > count(a) and not _overlaps(routes[a], routes[b]):
+                order[k], order[k + 1] = b, a
+                moved = True
+    return order
+
 # route_redirect provided by Peter Bengtsson via the Tornado mailing list
 # and then improved by Ben Darnell.
 # Use it as follows to redirect other paths into your decorated handler.
@@ -69,8 +278,11 @@ class route(object):
 #   class SmartphoneHandler(RequestHandler):
 #        def get(self):
 #            ...
-def route_redirect(from_, to, name=None):
-    route._routes.append(tornado.web.url(
+#
+# Pass registry=some_registry to put the redirect somewhere other than the
+# default route list.
+def route_redirect(from_, to, name=None, registry=route):
+    registry._routes.append(tornado.web.url(
         from_,
         tornado.web.RedirectHandler,
         dict(url=to),